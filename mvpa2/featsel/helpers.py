@@ -469,6 +469,9 @@ class TailSelector(ElementSelector):
         return list(good_ids)
 
 
+    tail = property(fget=lambda self:self.__tail, fset=_set_tail)
+
+
 
 class FixedNElementTailSelector(TailSelector):
     """Given a sequence, provide set of IDs for a fixed number of to be selected
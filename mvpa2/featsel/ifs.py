@@ -15,19 +15,39 @@ set and include important features successively.
 
 __docformat__ = 'restructuredtext'
 
+import heapq
 import numpy as np
-from mvpa2.support.copy import copy
-from mvpa2.featsel.base import StaticFeatureSelection, IterativeFeatureSelection
+from mvpa2.base import externals
+from mvpa2.base.dochelpers import _repr_attrs
+from mvpa2.misc.support import get_rng
+from mvpa2.featsel.base import IterativeFeatureSelection
 from mvpa2.featsel.helpers import NBackHistoryStopCrit, \
                                  FixedNElementTailSelector, \
                                  BestDetector
 
 from mvpa2.base.state import ConditionalAttribute
 
+if externals.exists('joblib'):
+    import joblib as jl
+
 if __debug__:
     from mvpa2.base import debug
 
 
+def _eval_candidate(trainds, fmeasure, ids):
+    """Helper function to be used to parallelize IFS candidate evaluation
+    """
+    # take the new candidate and all already selected features (ids)
+    # select a new temporay feature subset from the training part of the
+    # dataset -- slice it directly, no need to construct and train a
+    # feature selection mapper per candidate
+    candidate_ds = trainds[:, ids]
+    # compute data measure on the training part of this feature set
+    # and return it as a plain scalar, so workers do not need to pass
+    # complete datasets back -- relies on ds.item() to work properly
+    return np.asscalar(fmeasure(candidate_ds))
+
+
 class IFS(IterativeFeatureSelection):
     """Incremental feature search.
 
@@ -51,6 +71,12 @@ class IFS(IterativeFeatureSelection):
                  splitter,
                  fselector=FixedNElementTailSelector(1, tail='upper',
                                                      mode='select'),
+                 nproc=1,
+                 use_cache=False,
+                 ncandidates=None,
+                 rng=None,
+                 prune=False,
+                 dtype=None,
                  **kwargs):
         """Initialize incremental feature search
 
@@ -66,86 +92,279 @@ class IFS(IterativeFeatureSelection):
           This splitter instance has to generate at least two dataset splits
           when called with the input dataset. The first split serves as the
           training dataset and the second as the evaluation dataset.
+        nproc : int
+          Number of processes to use for evaluating the feature candidates
+          of each step in parallel.  Requires `joblib`; 1 (default) evaluates
+          them sequentially and -1 uses all available cores.  If IFS is
+          itself trained within an outer parallel loop, e.g. when running
+          the folds of an outer cross-validation with `joblib`, the number
+          of outer workers times `nproc` should not exceed the number of
+          cores, e.g. one outer worker per fold and ``cores / folds`` for
+          `nproc`.
+        use_cache : bool
+          If True, the measure computed for each candidate feature set is
+          stored and reused whenever the same feature set is evaluated again.
+          Within a single training no feature set is evaluated twice, so
+          this only pays off when retraining on the same dataset, e.g. after
+          changing `ncandidates`, `prune` or `nproc`.  The cache is dropped
+          upon `untrain()` or as soon as a different dataset or `dtype` is
+          used for training.  Results of a stochastic `fmeasure` get frozen
+          by the cache.  Note that the cache is unbounded: it keeps an entry
+          with all feature ids for every evaluated feature set, i.e. memory
+          grows with the number of features times the square of the number
+          of selection steps.
+        ncandidates : int or None
+          If not None, only a random subset of that many of the remaining
+          candidates is evaluated at each step following the first one.
+          This reduces the number of measure computations per step from the
+          number of remaining features to `ncandidates`, but the features
+          selected at a step are then only the best among the sampled
+          candidates, i.e. the selection is no longer guaranteed to match
+          the one of the exhaustive search and it depends on `rng`.
+        rng : int or RandomState, optional
+          Integer to seed a new RandomState upon each call, or instance of the
+          numpy.random.RandomState to be reused across calls. If None, the
+          numpy.random singleton would be used
+        prune : bool
+          If True, the measure a candidate got at the previous step is taken
+          as the best it could reach at the current one.  Candidates are then
+          evaluated in the order of this bound and the evaluation stops as
+          soon as none of the remaining candidates could make it into the
+          selection.  Since adding features to the selection might as well
+          make a candidate more informative (e.g. for interacting features),
+          this trades accuracy of the search for speed.  Requires `fselector`
+          to be a `FixedNElementTailSelector` in 'select' mode.
+        dtype : dtype or None
+          If not None, the samples are converted to this type (e.g.
+          `numpy.float32`) before any measure is computed, which halves
+          the memory traffic of double precision data for learners that
+          can make use of single precision.  The input dataset is not
+          modified.
         """
         # bases init first
         IterativeFeatureSelection.__init__(self, fmeasure, pmeasure, splitter,
                                            fselector, **kwargs)
+        self.nproc = nproc
+        self.use_cache = use_cache
+        self.ncandidates = ncandidates
+        self._rng = rng
+        self.prune = prune
+        self.dtype = dtype
+        self._cache = {}
+        """Measures of already evaluated feature sets"""
+        self._cache_idhash = None
+        """idhash of the dataset and dtype the cached measures were computed
+        on"""
+        self._check_params()
+
+
+    def _check_params(self):
+        """Verify that the (modifiable) search parameters are sensible
+        """
+        if self.ncandidates is not None and self.ncandidates < 1:
+            raise ValueError("ncandidates must be at least 1. Got %s"
+                             % (self.ncandidates,))
+        fselector = self._fselector
+        if self.prune and not (
+                isinstance(fselector, FixedNElementTailSelector)
+                and fselector.mode == 'select'):
+            raise ValueError("Pruning requires a FixedNElementTailSelector "
+                             "in 'select' mode as fselector. Got %s"
+                             % (fselector,))
+
+
+    def __repr__(self, prefixes=None):
+        if prefixes is None:
+            prefixes = []
+        return super(IFS, self).__repr__(
+            prefixes=prefixes
+            + _repr_attrs(self, ['nproc'], default=1)
+            + _repr_attrs(self, ['use_cache'], default=False)
+            + _repr_attrs(self, ['ncandidates'], default=None)
+            + _repr_attrs(self, ['prune'], default=False)
+            + _repr_attrs(self, ['dtype'], default=None))
+
+
+    def _eval_candidates(self, trainds, selected, candidates, cache):
+        """Compute the measure for each candidate added to the selection
+
+        Returns
+        -------
+        array of scalar measures, one per candidate
+        """
+        fmeasure = self._fmeasure
+        if cache is None:
+            todo = candidates
+        else:
+            # only evaluate feature sets which were not seen before
+            selected_key = tuple(selected)
+            todo = [c for c in candidates
+                    if selected_key + (c,) not in cache]
+
+        # measures for all candidates
+        if self.nproc != 1 and externals.exists('joblib'):
+            measures = np.fromiter(jl.Parallel(self.nproc)(
+                jl.delayed(_eval_candidate)(trainds, fmeasure,
+                                            np.append(selected, candidate))
+                for candidate in todo), dtype=float, count=len(todo))
+        else:
+            measures = np.empty(len(todo))
+            # for all possible candidates
+            for i, candidate in enumerate(todo):
+                if __debug__:
+                    debug('IFSC', "Tested %i" % i, cr=True)
+                # fresh ids for each candidate, since the mapper of the
+                # sliced dataset might keep a reference to them
+                measures[i] = _eval_candidate(trainds, fmeasure,
+                                              np.append(selected, candidate))
+
+        if cache is not None:
+            for candidate, m in zip(todo, measures):
+                cache[selected_key + (candidate,)] = m
+            measures = np.fromiter((cache[selected_key + (c,)]
+                                    for c in candidates),
+                                   dtype=float, count=len(candidates))
+        return measures
 
 
     def _train(self, ds):
+        # parameters might have been changed since construction
+        self._check_params()
         # local binding
-        fmeasure = self._fmeasure
         fselector = self._fselector
         scriterion = self._stopping_criterion
         bestdetector = self._bestdetector
+        ncandidates = self.ncandidates
+        rng = get_rng(self._rng)
+        prune = self.prune
+        if prune:
+            # sign to turn measures into scores where larger is better
+            sign = 1 if fselector.tail == 'upper' else -1
+            nelements = fselector.nelements
+            # how many candidates to evaluate at once before checking
+            # whether the remaining ones could still get selected
+            if self.nproc != 1 and externals.exists('joblib'):
+                batchsize = self.nproc if self.nproc > 0 \
+                            else max(jl.cpu_count() + 1 + self.nproc, 1)
+            else:
+                batchsize = 1
+            # best measure each candidate is expected to reach
+            bounds = np.empty(ds.nfeatures)
+
+        # get the split into train and test once -- the part used for
+        # computing the selection criterion is the same for all candidates
+        trainds, testds = self._get_traintest_ds(ds)
+        if self.dtype is not None:
+            # convert samples without touching the input dataset
+            trainds = trainds.copy(deep=False)
+            trainds.samples = trainds.samples.astype(self.dtype)
+            testds = testds.copy(deep=False)
+            testds.samples = testds.samples.astype(self.dtype)
 
         # init
         # Computed error for each tested features set.
         errors = []
         # feature candidate are all features in the pattern object
-        candidates = range(ds.nfeatures)
-        # initially empty list of selected features
-        selected = []
+        candidates = np.arange(ds.nfeatures)
+        # flags which of the candidates are still available for selection
+        alive = np.ones(len(candidates), dtype=bool)
+        # initially empty set of selected feature ids
+        selected = np.empty(0, dtype=np.intp)
         # results in here please
         results = None
+        # previously computed measures (if any) are only valid for the very
+        # same dataset converted to the same dtype
+        if self.use_cache:
+            cache_idhash = (ds.idhash, self.dtype)
+            if self._cache_idhash != cache_idhash:
+                self._cache = {}
+                self._cache_idhash = cache_idhash
+            cache = self._cache
+        else:
+            cache = None
 
         # as long as there are candidates left
         # the loop will most likely get broken earlier if the stopping
         # criterion is reached
-        while len(candidates):
-            # measures for all candidates
-            measures = []
+        while alive.any():
+            # indices and ids of the remaining candidates
+            live_idx = np.flatnonzero(alive)
+            if ncandidates is not None and len(selected) \
+                    and len(live_idx) > ncandidates:
+                # evaluate only a random subset of them
+                live_idx = np.sort(rng.choice(live_idx, ncandidates,
+                                              replace=False))
+            live = candidates[live_idx]
 
-            # for all possible candidates
-            for i, candidate in enumerate(candidates):
-                if __debug__:
-                    debug('IFSC', "Tested %i" % i, cr=True)
+            if prune and len(selected):
+                # evaluate the most promising candidates first and stop as
+                # soon as none of the remaining ones could make it into the
+                # selection anymore -- those keep their bound as measure
+                measures = bounds[live_idx]
+                order = np.argsort(-sign * measures)
+                # scores of the best nelements candidates evaluated so far,
+                # worst of them first
+                top = []
+                # number of candidates (in bound order) whose evaluation
+                # counts
+                nevaluated = 0
+                for start in xrange(0, len(order), batchsize):
+                    batch = order[start:start + batchsize]
+                    if len(top) >= nelements \
+                            and sign * measures[batch[0]] < top[0]:
+                        # none of the remaining could get selected
+                        break
+                    batch_measures = self._eval_candidates(
+                        trainds, selected, live[batch], cache)
+                    # take the results in bound order, exactly as if the
+                    # candidates were evaluated one at a time, so the
+                    # selection does not depend on the batch size (nproc)
+                    for i, m in zip(batch, batch_measures):
+                        if len(top) >= nelements \
+                                and sign * measures[i] < top[0]:
+                            break
+                        measures[i] = m
+                        nevaluated += 1
+                        if len(top) < nelements:
+                            heapq.heappush(top, sign * m)
+                        else:
+                            heapq.heappushpop(top, sign * m)
+                    if nevaluated < start + len(batch):
+                        break
+                if __debug__ and nevaluated < len(order):
+                    debug('IFSC', "Pruned %i of %i candidates"
+                          % (len(order) - nevaluated, len(order)))
+            else:
+                measures = self._eval_candidates(trainds, selected, live,
+                                                 cache)
 
-                # take the new candidate and all already selected features
-                # select a new temporay feature subset from the dataset
-                # slice the full dataset, because for the initial iteration
-                # steps this will be much mure effecient than splitting the
-                # full ds into train and test at first
-                fslm = StaticFeatureSelection(selected + [candidate])
-                fslm.train(ds)
-                candidate_ds = fslm(ds)
-                # activate the dataset splitter
-                dsgen = self._splitter.generate(candidate_ds)
-                # and derived the dataset part that is used for computing the selection
-                # criterion
-                trainds = dsgen.next()
-                # compute data measure on the training part of this feature set
-                measures.append(fmeasure(trainds))
-
-            # relies on ds.item() to work properly
-            measures = [np.asscalar(m) for m in measures]
+            if prune:
+                # measures of this step serve as bounds for the next one
+                bounds[live_idx] = measures
 
             # Select promissing feature candidates (staging)
             # IDs are only applicable to the current set of feature candidates
             tmp_staging_ids = fselector(measures)
 
             # translate into real candidate ids
-            staging_ids = [candidates[i] for i in tmp_staging_ids]
+            staging_idx = live_idx[tmp_staging_ids]
+            staging_ids = candidates[staging_idx]
 
             # mark them as selected and remove from candidates
-            selected += staging_ids
-            for i in staging_ids:
-                candidates.remove(i)
+            selected = np.concatenate((selected, staging_ids))
+            alive[staging_idx] = False
 
             # actually run the performance measure to estimate "quality" of
             # selection
-            fslm = StaticFeatureSelection(selected)
-            fslm.train(ds)
-            selectedds = fslm(ds)
-            # split into train and test part
-            trainds, testds = self._get_traintest_ds(selectedds)
+            wtrainds = trainds[:, selected]
+            wtestds = testds[:, selected]
             # evaluate and store
-            error = self._evaluate_pmeasure(trainds, testds)
+            error = self._evaluate_pmeasure(wtrainds, wtestds)
             errors.append(np.asscalar(error))
             # intermediate cleanup, so the datasets do not hand around while
             # the next candidate evaluation is computed
-            del trainds
-            del testds
+            del wtrainds
+            del wtestds
 
             # Check if it is time to stop and if we got
             # the best result
@@ -161,8 +380,9 @@ class IFS(IterativeFeatureSelection):
 
             if isthebest:
                 # announce desired features to the underlying slice mapper
-                # do copy to survive later selections
-                self._safe_assign_slicearg(copy(selected))
+                # no copy needed to survive later selections, since those
+                # create a new array instead of modifying this one
+                self._safe_assign_slicearg(selected)
 
             # leave the loop when the criterion is reached
             if stop:
@@ -170,3 +390,9 @@ class IFS(IterativeFeatureSelection):
 
         # charge state
         self.ca.errors = errors
+
+
+    def _untrain(self):
+        self._cache = {}
+        self._cache_idhash = None
+        super(IFS, self)._untrain()
@@ -16,14 +16,37 @@ from mvpa2.testing.datasets import datasets
 from mvpa2.base.dataset import vstack
 from mvpa2.datasets.base import Dataset
 from mvpa2.featsel.ifs import IFS
-from mvpa2.measures.base import CrossValidation, ProxyMeasure
+from mvpa2.measures.base import Measure, CrossValidation, ProxyMeasure
 from mvpa2.generators.partition import NFoldPartitioner
 from mvpa2.generators.splitters import Splitter
-from mvpa2.featsel.helpers import FixedNElementTailSelector
+from mvpa2.featsel.helpers import FixedNElementTailSelector, \
+                                 FractionTailSelector
 from mvpa2.mappers.fx import mean_sample, BinaryFxNode
 from mvpa2.misc.errorfx import mean_mismatch_error
+from mvpa2.clfs.gnb import GNB
 
 
+class _RecordingMeasure(Measure):
+    # used to check how often, and on samples of which dtype, the wrapped
+    # measure gets trained and computed
+    is_trained = True
+
+    def __init__(self, measure, **kwargs):
+        Measure.__init__(self, **kwargs)
+        self._measure = measure
+        self.ncalls = 0
+        self.train_dtypes = set()
+        self.call_dtypes = set()
+
+    def _train(self, ds):
+        self.train_dtypes.add(ds.samples.dtype)
+        self._measure.train(ds)
+
+    def _call(self, ds):
+        self.ncalls += 1
+        self.call_dtypes.add(ds.samples.dtype)
+        return self._measure(ds)
+
 
 class IFSTests(unittest.TestCase):
 
@@ -76,6 +99,52 @@ class IFSTests(unittest.TestCase):
         e = np.array(ifs.ca.errors)
         self.assertTrue(resds.nfeatures == e.argmin() + 1)
 
+        # evaluating only a random subset of the candidates after the first
+        # step must be reproducible given the rng
+        cfmeasure = _RecordingMeasure(fmeasure)
+        ifs_sub = IFS(cfmeasure, pmeasure,
+                      Splitter('purpose', attr_values=['train', 'test']),
+                      fselector=FixedNElementTailSelector(1, tail='lower',
+                                                          mode='select'),
+                      ncandidates=3, rng=1)
+        ifs_sub.train(ds)
+        # after the first step at most 3 candidates are evaluated per step
+        assert_equal(cfmeasure.ncalls,
+                     ds.nfeatures
+                     + sum(min(3, ds.nfeatures - i)
+                           for i in xrange(1, len(ifs_sub.ca.errors))))
+        _slicearg = ifs_sub.slicearg
+        ifs_sub.train(ds)
+        assert_array_equal(_slicearg, ifs_sub.slicearg)
+        # and the first step is still exhaustive
+        assert_equal(ifs_sub.slicearg[0], ifs.slicearg[0])
+        # at least one candidate has to be evaluated
+        self.assertRaises(ValueError, IFS, fmeasure, pmeasure,
+                          Splitter('purpose', attr_values=['train', 'test']),
+                          ncandidates=0)
+        ifs_sub.ncandidates = 0
+        self.assertRaises(ValueError, ifs_sub.train, ds)
+
+        # pruning needs to know what and how many elements get selected
+        self.assertRaises(ValueError, IFS, fmeasure, pmeasure,
+                          Splitter('purpose', attr_values=['train', 'test']),
+                          fselector=FractionTailSelector(0.1, mode='select'),
+                          prune=True)
+        # also when enabled after construction
+        ifs_frac = IFS(fmeasure, pmeasure,
+                       Splitter('purpose', attr_values=['train', 'test']),
+                       fselector=FractionTailSelector(0.1, mode='select'))
+        ifs_frac.prune = True
+        self.assertRaises(ValueError, ifs_frac.train, ds)
+        ifs_prune = IFS(fmeasure, pmeasure,
+                        Splitter('purpose', attr_values=['train', 'test']),
+                        fselector=FixedNElementTailSelector(1, tail='lower',
+                                                            mode='select'),
+                        prune=True)
+        ifs_prune.train(ds)
+        assert_equal(ifs_prune.slicearg[0], ifs.slicearg[0])
+        self.assertTrue(len(ifs_prune.ca.errors))
+
 
         # repeat with dataset where selection order is known
         wsignal = datasets['dumb2'].copy()
@@ -87,6 +156,94 @@ class IFSTests(unittest.TestCase):
         resds = ifs(signal)
         self.assertTrue((resds.samples[:,0] == signal.samples[:,0]).all())
 
+        if externals.exists('joblib'):
+            # compare results against the one ran in parallel
+            _slicearg = ifs.slicearg
+            _errors = ifs.ca.errors
+            ifs.nproc = -1
+            ifs.train(signal)
+            assert_array_equal(_slicearg, ifs.slicearg)
+            assert_array_equal(_errors, ifs.ca.errors)
+
+        # single precision samples are good enough to find the signal
+        rfmeasure = _RecordingMeasure(fmeasure)
+        rpmeasure = _RecordingMeasure(pmeasure)
+        ifs_single = IFS(rfmeasure, rpmeasure,
+                         Splitter('purpose', attr_values=['train', 'test']),
+                         fselector=FixedNElementTailSelector(1, tail='lower',
+                                                             mode='select'),
+                         dtype=np.float32)
+        ifs_single.train(signal)
+        resds = ifs_single(signal)
+        self.assertTrue((resds.samples[:,0] == signal.samples[:,0]).all())
+        # all measures only ever got to see converted samples
+        assert_equal(rfmeasure.call_dtypes, set([np.dtype(np.float32)]))
+        assert_equal(rpmeasure.train_dtypes, set([np.dtype(np.float32)]))
+        assert_equal(rpmeasure.call_dtypes, set([np.dtype(np.float32)]))
+        # input dataset stays untouched
+        assert_equal(signal.samples.dtype, wsignal.samples.dtype)
+
+        # reusing cached measures must not alter the selection
+        _slicearg = ifs.slicearg
+        _errors = ifs.ca.errors
+        cfmeasure = _RecordingMeasure(fmeasure)
+        ifs_cache = IFS(cfmeasure, pmeasure,
+                        Splitter('purpose', attr_values=['train', 'test']),
+                        fselector=FixedNElementTailSelector(1, tail='lower',
+                                                            mode='select'),
+                        use_cache=True)
+        ifs_cache.train(signal)
+        self.assertTrue(cfmeasure.ncalls > 0)
+        self.assertTrue(len(ifs_cache._cache))
+        # no measure is computed again upon retraining
+        cfmeasure.ncalls = 0
+        ifs_cache.train(signal)
+        assert_equal(cfmeasure.ncalls, 0)
+        assert_array_equal(_slicearg, ifs_cache.slicearg)
+        assert_array_equal(_errors, ifs_cache.ca.errors)
+        # measures on differently converted samples are not reused
+        ifs_cache.dtype = np.float32
+        ifs_cache.train(signal)
+        self.assertTrue(cfmeasure.ncalls > 0)
+        # but gets dropped upon untrain
+        ifs_cache.untrain()
+        assert_equal(len(ifs_cache._cache), 0)
+
+
+    @reseed_rng()
+    def test_ifs_prune(self):
+        ds = Dataset.from_wizard(np.random.standard_normal((40, 24)),
+                                 targets=np.repeat([0, 1], 20),
+                                 chunks=np.tile(range(4), 10))
+        # some signal in the first features
+        ds.samples[ds.targets == 1, :3] += 0.7
+        ds.sa['purpose'] = np.tile(['train', 'test'], 20)
+        fmeasure = _RecordingMeasure(
+            CrossValidation(GNB(), NFoldPartitioner(), postproc=mean_sample()))
+        pmeasure = ProxyMeasure(GNB(), postproc=BinaryFxNode(
+            mean_mismatch_error, 'targets'))
+
+        ifs = IFS(fmeasure, pmeasure,
+                  Splitter('purpose', attr_values=['train', 'test']),
+                  fselector=FixedNElementTailSelector(1, tail='lower',
+                                                      mode='select'),
+                  prune=True)
+        ifs.train(ds)
+        # some candidates got pruned, i.e. less measures were computed than
+        # an exhaustive search would need for the same number of steps
+        nsteps = len(ifs.ca.errors)
+        self.assertTrue(fmeasure.ncalls
+                        < sum(ds.nfeatures - i for i in xrange(nsteps)))
+
+        if externals.exists('joblib'):
+            # selection must not depend on the number of processes, which
+            # determines how many candidates get evaluated at once
+            _slicearg = ifs.slicearg
+            for nproc in (-1, 2, 3):
+                ifs.nproc = nproc
+                ifs.train(ds)
+                assert_array_equal(_slicearg, ifs.slicearg)
+
 
 def suite():  # pragma: no cover
     return unittest.makeSuite(IFSTests)